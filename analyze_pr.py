@@ -1,17 +1,47 @@
 #!/usr/bin/env python3
 
 import os
-import json
+import asyncio
+import hashlib
+import hmac
+import ijson
+import ipaddress
+import mimetypes
+import orjson
 import requests
 import re
+import socket
 import sys
-from typing import Optional, Dict, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional, Dict, Any, BinaryIO, Tuple
+from urllib.parse import urljoin, urlparse
 import google.generativeai as genai
+import numpy as np
+from aiohttp import web
+from cachetools import TTLCache
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Get environment variables
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GITHUB_EVENT_PATH = os.getenv("GITHUB_EVENT_PATH")
+CACHE_DIR = os.getenv("PR_ANALYZER_CACHE_DIR", ".cache")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8080"))
+
+# Largest image we will download for analysis
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Longest we will wait for GitHub's primary rate limit to reset before giving up
+RATE_LIMIT_MAX_WAIT = 15 * 60
+
+# Webhook server mode instead of a one-shot GitHub Action run
+SERVE = "--serve" in sys.argv[1:]
 
 # Validation
 if not GITHUB_TOKEN:
@@ -22,13 +52,468 @@ if not GEMINI_API_KEY:
     print("ERROR: GEMINI_API_KEY is not set")
     sys.exit(1)
 
-if not GITHUB_EVENT_PATH:
+if SERVE and not WEBHOOK_SECRET:
+    print("ERROR: WEBHOOK_SECRET is not set")
+    sys.exit(1)
+
+if not SERVE and not GITHUB_EVENT_PATH:
     print("ERROR: GITHUB_EVENT_PATH is not set")
     sys.exit(1)
 
+# Log markers: emoji where stdout can encode them, ASCII tokens otherwise
+_UTF8_STDOUT = "utf" in (getattr(sys.stdout, "encoding", None) or "").lower()
+BOT = "🤖" if _UTF8_STDOUT else "[BOT]"
+OK = "✅" if _UTF8_STDOUT else "[OK]"
+FAIL = "❌" if _UTF8_STDOUT else "[FAIL]"
+INFO = "📝" if _UTF8_STDOUT else "[INFO]"
+
 # Configure Gemini AI
 genai.configure(api_key=GEMINI_API_KEY)
 
+GEMINI_MODEL = "gemini-2.5-flash"
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Static reviewer role, sent as the system instruction rather than repeated in
+# every prompt. At ~100 tokens it is well below the 1,024-token minimum for
+# Gemini's implicit prompt caching, so this gives no caching benefit
+REVIEWER_INSTRUCTION = """You are a helpful code reviewer AI assistant. Analyze the pull request you are given and provide a concise, crisp response in exactly 2 lines.
+
+Please provide:
+1. A brief assessment of the PR (first line)
+2. A specific suggestion or observation (second line)
+
+Keep it short, professional, and actionable. Format as plain text, exactly 2 lines."""
+
+# Built once per process; the system instruction is the same for every PR
+_MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=REVIEWER_INSTRUCTION)
+
+# Analyses keyed by a hash of the PR content, so repeated events for an
+# unchanged PR (edits, synchronize) don't trigger another Gemini call
+_ANALYSIS_CACHE = TTLCache(maxsize=512, ttl=600)
+# TTLCache is not thread-safe; webhook tasks reach it from worker threads
+_ANALYSIS_CACHE_LOCK = threading.Lock()
+
+
+class SemanticCache:
+    """Ring buffer of (embedding, analysis) pairs for near-duplicate PRs"""
+
+    def __init__(self, path: str, capacity: int = 1024, threshold: float = 0.85):
+        self.path = path
+        self.capacity = capacity
+        self.threshold = threshold
+        self.embeddings: Optional[np.ndarray] = None  # unit-length rows
+        self.repos: list = []
+        self.analyses: list = []
+        self.next_slot = 0
+        # Webhook tasks look up, add and save from several worker threads
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Restore the buffer persisted by a previous run, if any"""
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                embeddings = data["embeddings"][:self.capacity]
+                self.repos = data["repos"].tolist()[:self.capacity]
+                self.analyses = data["analyses"].tolist()[:self.capacity]
+                self.next_slot = int(data["next_slot"]) % self.capacity
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"WARNING: Failed to load semantic cache from {self.path}: {str(e)}")
+            self.repos, self.analyses, self.next_slot = [], [], 0
+            return
+
+        self.embeddings = np.zeros((self.capacity, embeddings.shape[1]), dtype=np.float32)
+        self.embeddings[:len(embeddings)] = embeddings
+
+    def save(self):
+        """Persist the filled part of the buffer for the next run"""
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez(
+                        f,
+                        embeddings=self.embeddings[:len(self.analyses)],
+                        repos=np.array(self.repos, dtype=str),
+                        analyses=np.array(self.analyses, dtype=str),
+                        next_slot=self.next_slot,
+                    )
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"WARNING: Failed to save semantic cache to {self.path}: {str(e)}")
+
+    def lookup(self, repo: str, vector: np.ndarray) -> Optional[str]:
+        """Return the cached analysis most similar to vector, if close enough"""
+        with self.lock:
+            if not self.analyses or self.embeddings.shape[1] != vector.shape[0]:
+                return None
+
+            scores = self.embeddings[:len(self.analyses)] @ vector
+            # Only reuse analyses written for the same repository
+            scores[np.array(self.repos) != repo] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self.analyses[best]
+            return None
+
+    def add(self, repo: str, vector: np.ndarray, analysis: str):
+        """Store an analysis, overwriting the oldest entry once full"""
+        with self.lock:
+            if self.embeddings is None or self.embeddings.shape[1] != vector.shape[0]:
+                # First entry, or the embedding model changed: start over
+                self.embeddings = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                self.repos, self.analyses, self.next_slot = [], [], 0
+
+            slot = self.next_slot
+            self.embeddings[slot] = vector
+            if slot < len(self.analyses):
+                self.repos[slot] = repo
+                self.analyses[slot] = analysis
+            else:
+                self.repos.append(repo)
+                self.analyses.append(analysis)
+            self.next_slot = (slot + 1) % self.capacity
+
+
+_SEMANTIC_CACHE = SemanticCache(os.path.join(CACHE_DIR, "embeds.npz"))
+
+
+class ETagCache:
+    """ETags of downloaded images by URL, with the (downscaled) image bytes kept in per-URL files
+
+    The JSON index holds only url -> [etag, size]; it is read on first use (so
+    text-only PRs never touch it) and rewritten only when an entry changed. The
+    oldest entries are evicted past max_entries or max_bytes of stored images,
+    which keeps the directory small enough to restore and save on every run.
+    """
+
+    def __init__(self, index_path: str, data_dir: str, max_entries: int = 32,
+                 max_bytes: int = 4 * 1024 * 1024):
+        self.index_path = index_path
+        self.data_dir = data_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.etags: Optional[Dict[str, list]] = None  # Loaded lazily
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def _data_path(self, url: str) -> str:
+        return os.path.join(self.data_dir, hashlib.sha256(url.encode()).hexdigest())
+
+    def _load(self):
+        """Read the index persisted by a previous run, if not done yet (lock held)"""
+        if self.etags is not None:
+            return
+        try:
+            with open(self.index_path, "rb") as f:
+                entries = orjson.loads(f.read())
+            # Skip anything not in the current [etag, size] format
+            self.etags = {
+                url: entry for url, entry in entries.items()
+                if isinstance(entry, list) and len(entry) == 2
+            }
+        except FileNotFoundError:
+            self.etags = {}
+        except Exception as e:
+            print(f"WARNING: Failed to load ETag cache from {self.index_path}: {str(e)}")
+            self.etags = {}
+
+    def save(self):
+        """Persist the index for the next run, if anything changed"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+                tmp_path = f"{self.index_path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(orjson.dumps(self.etags))
+                os.replace(tmp_path, self.index_path)
+                self.dirty = False
+            except Exception as e:
+                print(f"WARNING: Failed to save ETag cache to {self.index_path}: {str(e)}")
+
+    def get(self, url: str) -> Optional[str]:
+        """ETag of the stored copy of url, if we still have its bytes"""
+        with self.lock:
+            self._load()
+            entry = self.etags.get(url)
+        etag = entry[0] if entry else None
+        if etag and os.path.exists(self._data_path(url)):
+            return etag
+        return None
+
+    def read(self, url: str) -> bytes:
+        """Bytes of the stored copy of url (after a 304)"""
+        with open(self._data_path(url), "rb") as f:
+            return f.read()
+
+    def put(self, url: str, etag: str, data: bytes):
+        """Store a freshly downloaded image, evicting the oldest entries past the limits"""
+        with self.lock:
+            self._load()
+            entry = self.etags.get(url)
+            if entry and entry[0] == etag and os.path.exists(self._data_path(url)):
+                return  # Same validator, same bytes
+
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            data_path = self._data_path(url)
+            tmp_path = f"{data_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, data_path)
+        except Exception as e:
+            print(f"WARNING: Failed to store {url} in the ETag cache: {str(e)}")
+            return
+
+        with self.lock:
+            self.etags.pop(url, None)
+            self.etags[url] = [etag, len(data)]
+            self.dirty = True
+            while self.etags and (len(self.etags) > self.max_entries
+                                  or sum(size for _, size in self.etags.values()) > self.max_bytes):
+                evicted = next(iter(self.etags))
+                del self.etags[evicted]
+                try:
+                    os.remove(self._data_path(evicted))
+                except OSError:
+                    pass
+
+
+# Event payload paths (as ijson prefixes) -> pr_details keys
+_PR_EVENT_FIELDS = {
+    "action": "action",
+    "pull_request.title": "title",
+    "pull_request.body": "description",
+    "pull_request.number": "number",
+    "pull_request.html_url": "url",
+    "repository.full_name": "repo",
+}
+_CONTAINER_EVENTS = {"start_map", "end_map", "start_array", "end_array", "map_key"}
+
+# Section markers in batched Gemini responses: "=== PR 3 ===", possibly
+# wrapped in Markdown emphasis or a heading ("**=== PR 3 ===**", "## === PR 3 ===")
+_BATCH_MARKER_PATTERN = re.compile(r'^[\s*_#]*=== PR (\d+) ===[\s*_]*$', re.MULTILINE)
+
+# pull_request webhook actions worth commenting on (same as the example workflow)
+PR_ACTIONS = {"opened", "edited", "synchronize", "reopened"}
+
+# Markdown ![alt](url) or HTML <img src="url">
+_IMAGE_PATTERN = re.compile(
+    r'!\[[^\]]*\]\(([^)]+)\)|<img[^>]+src=["\']([^"\']+)["\']',
+    re.IGNORECASE,
+)
+
+# Inline base64 images (data:image/png;base64,...) in descriptions
+_DATA_URI_PATTERN = re.compile(r'\bdata:image/[\w.+-]+;base64,[A-Za-z0-9+/=]+')
+
+
+def clip_description(description: Optional[str], head: int = 4000, tail: int = 2000) -> str:
+    """Drop inline data URIs and keep only the head and tail of a long description"""
+    description = _DATA_URI_PATTERN.sub("[inline image omitted]", description or "")
+    if len(description) <= head + tail + 32:
+        return description
+    return description[:head] + "\n...[truncated]...\n" + description[-tail:]
+
+
+def format_pr_for_prompt(pr_details: Dict[str, Any]) -> str:
+    """Render the per-PR part of a Gemini prompt"""
+    return f"""Pull Request Title: {pr_details['title']}
+
+Pull Request Description:
+{clip_description(pr_details['description'])}
+
+Repository: {pr_details['repo']}"""
+
+
+def collect_stream_text(response) -> str:
+    """Join a streamed Gemini response; errors surface as soon as the stream breaks"""
+    # Chunks without parts (e.g. the final metadata chunk) have no .text
+    text = "".join(chunk.text for chunk in response if chunk.parts).strip()
+    if not text:
+        # e.g. stopped for SAFETY/RECITATION, or the prompt itself was blocked
+        if response.candidates:
+            reason = response.candidates[0].finish_reason
+        else:
+            reason = response.prompt_feedback.block_reason
+        raise ValueError(f"Gemini returned no text (reason: {getattr(reason, 'name', reason)})")
+    return text
+
+
+def guess_image_mime_type(image_url: str, image_data: bytes) -> str:
+    """Determine an image's MIME type from its magic bytes, falling back to the URL"""
+    if image_data.startswith(b"\x89PNG"):
+        return "image/png"
+    if image_data.startswith(b"GIF8"):
+        return "image/gif"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    if image_data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+
+    mime_type = mimetypes.guess_type(urlparse(image_url).path)[0]
+    if mime_type and mime_type.startswith("image/"):
+        return mime_type
+    return "image/jpeg"
+
+
+def is_public_https_url(url: str) -> bool:
+    """Whether url is https and its host resolves only to public addresses"""
+    parsed = urlparse(url)
+    if parsed.scheme != "https" or not parsed.hostname:
+        return False
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 443, proto=socket.IPPROTO_TCP)
+        return bool(addresses) and all(
+            ipaddress.ip_address(sockaddr[0]).is_global for *_, sockaddr in addresses
+        )
+    except (OSError, ValueError):
+        return False
+
+
+def downscale_image(image_data: bytes, mime_type: str, max_side: int = 1024) -> Tuple[bytes, str]:
+    """Shrink large images to at most max_side pixels as JPEG; small ones pass through"""
+    if len(image_data) < 200 * 1024:
+        return image_data, mime_type
+
+    try:
+        with Image.open(BytesIO(image_data)) as img:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                # JPEG has no alpha; flatten onto white so transparent areas don't turn black
+                rgba = img.convert("RGBA")
+                flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                flattened = img.convert("RGB")
+            buf = BytesIO()
+            flattened.save(buf, "JPEG", quality=85, optimize=True)
+    except Exception as e:
+        print(f"WARNING: Failed to downscale image, sending original: {str(e)}")
+        return image_data, mime_type
+
+    return buf.getvalue(), "image/jpeg"
+
+
+class GitHubRetry(Retry):
+    """Retry policy for GitHub API calls
+
+    403s are retried only when GitHub says when to come back (secondary rate limits).
+    POSTs are retried only on secondary rate limits (a 403 or 429 with Retry-After),
+    never on gateway errors that may arrive after the comment was already created.
+    A primary-limit 429 has no Retry-After and won't clear within the backoff;
+    post_comment_on_pr waits for its reset instead.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        # A 403 without Retry-After is a permissions error; retrying won't help
+        if status_code == 403 and not has_retry_after:
+            return False
+        if method == "POST":
+            return bool(self.total) and has_retry_after and status_code in (403, 429)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def wait_for_rate_limit(response: requests.Response, threshold: int = 5, max_sleep: float = 60.0):
+    """Sleep until the rate limit window resets when few GitHub API calls remain"""
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None or int(remaining) >= threshold:
+        return
+
+    delay = min(max(0.0, int(reset) - time.time()), max_sleep)
+    print(f"WARNING: {remaining} GitHub API calls left; waiting {delay:.0f}s for the rate limit to reset")
+    time.sleep(delay)
+
+
+def primary_rate_limit_delay(response: requests.Response) -> Optional[float]:
+    """Seconds until the rate limit resets if GitHub rejected the call for having none left"""
+    if response.status_code not in (403, 429) or response.headers.get("X-RateLimit-Remaining") != "0":
+        return None
+    # One second of slack: the reset time is only given to the second
+    return max(0.0, int(response.headers.get("X-RateLimit-Reset", 0)) - time.time()) + 1
+
+
+class AnalysisBatcher:
+    """Coalesces PRs arriving close together into a single Gemini request (server mode)"""
+
+    def __init__(self, analyzer: "PRAnalyzer", max_batch: int = 8, max_wait: float = 0.2):
+        self.analyzer = analyzer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Batches in flight, kept referenced until done
+        self.batch_tasks = set()
+
+    async def analyze(self, pr_details: Dict[str, Any]) -> str:
+        """Get a fresh analysis for a PR, batched with any others waiting"""
+        if self.analyzer.extract_images_from_description(pr_details['description']):
+            # Images are attached per request, so these PRs are analyzed on their own
+            return await asyncio.to_thread(self.analyzer.generate_analysis, pr_details)
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((pr_details, future))
+        return await future
+
+    async def run(self):
+        """Collect up to max_batch PRs, waiting at most max_wait after the first"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Never combine repositories in one prompt: a private repo's PR must not
+            # share a request (or a mis-split answer) with another repo's PR
+            by_repo = {}
+            for item in batch:
+                by_repo.setdefault(item[0]['repo'], []).append(item)
+
+            # Each batch runs on its own so the queue keeps draining meanwhile
+            for repo_batch in by_repo.values():
+                task = asyncio.create_task(self._analyze_batch(repo_batch))
+                self.batch_tasks.add(task)
+                task.add_done_callback(self.batch_tasks.discard)
+
+    async def _analyze_batch(self, batch: list):
+        if len(batch) == 1:
+            results = [None]
+        else:
+            print(f"Analyzing {len(batch)} PRs in one Gemini request")
+            try:
+                results = await asyncio.to_thread(
+                    self.analyzer.generate_batch_analysis, [pr_details for pr_details, _ in batch]
+                )
+            except Exception as e:
+                print(f"WARNING: Batched analysis failed, retrying PRs individually: {str(e)}")
+                results = [None] * len(batch)
+
+        await asyncio.gather(*(
+            self._resolve(pr_details, future, analysis)
+            for (pr_details, future), analysis in zip(batch, results)
+        ))
+
+    async def _resolve(self, pr_details: Dict[str, Any], future: asyncio.Future, analysis: Optional[str]):
+        if analysis is None:
+            # Single PR, or the batch response had no section for it
+            try:
+                analysis = await asyncio.to_thread(self.analyzer.generate_analysis, pr_details)
+            except Exception as e:
+                future.set_exception(e)
+                return
+        future.set_result(analysis)
+
 
 class PRAnalyzer:
     def __init__(self, github_token: str, gemini_api_key: str):
@@ -39,133 +524,318 @@ class PRAnalyzer:
             "X-GitHub-Api-Version": "2022-11-28"
         }
 
-    def load_github_context(self) -> Dict[str, Any]:
-        """Load GitHub event context from file"""
+        # One pooled session for all outbound HTTP so connections (and their
+        # TLS handshakes) are reused across image downloads and the comment POST.
+        # GitHub credentials are passed per call so they never reach image hosts.
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": "ai-generated-pr-comment"})
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+        ))
+        # GitHub API calls additionally ride out rate limiting (most specific prefix wins)
+        self.session.mount("https://api.github.com/", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=8,
+            max_retries=GitHubRetry(
+                total=5,
+                backoff_factor=1.5,
+                status_forcelist=[403, 429, 502, 503, 504],
+                # POST is deliberately absent: is_retry opts it in for rate limits only,
+                # and read errors after the request was sent are never replayed
+                allowed_methods=frozenset(["GET"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            ),
+        ))
+
+        # Validators for images seen before, so unchanged ones come back as 304s
+        self.etag_cache = ETagCache(os.path.join(CACHE_DIR, "etags.json"), os.path.join(CACHE_DIR, "images"))
+
+        # In-flight webhook analyses (server mode), kept referenced until done
+        self.webhook_tasks = set()
+        # Comment POSTs (server mode) may sleep until a rate limit resets; keep
+        # them off the default executor that cache lookups and downloads use
+        self.comment_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="comment")
+
+    def load_pr_details(self) -> Dict[str, Any]:
+        """Load PR details from the GitHub event file"""
         try:
-            with open(GITHUB_EVENT_PATH, 'r') as f:
-                context = json.load(f)
-            return context
+            with open(GITHUB_EVENT_PATH, 'rb') as f:
+                return self.extract_pr_details(f)
         except FileNotFoundError:
             print(f"ERROR: GitHub event file not found at {GITHUB_EVENT_PATH}")
             sys.exit(1)
-        except json.JSONDecodeError:
-            print("ERROR: Failed to parse GitHub event file")
+        except ValueError as e:
+            print(f"ERROR: {str(e)}")
             sys.exit(1)
 
-    def extract_pr_details(self, context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Extract PR details from GitHub context"""
-        try:
-            pr = context.get("pull_request")
-            if not pr:
-                print("ERROR: This action can only run on pull_request events")
-                sys.exit(1)
-
-            pr_details = {
-                "title": pr.get("title", ""),
-                "description": pr.get("body", ""),
-                "number": pr.get("number"),
-                "url": pr.get("html_url"),
-                "repo": context.get("repository", {}).get("full_name"),
-            }
+    def extract_pr_details(self, event_file: BinaryIO) -> Dict[str, Any]:
+        """Stream PR details out of a GitHub event payload without building the full object
+
+        Raises ValueError if the payload is malformed or not a pull_request event.
+        """
+        pr_details = {
+            "action": None,
+            "title": "",
+            "description": "",
+            "number": None,
+            "url": None,
+            "repo": None,
+        }
+        is_pull_request = False
+        remaining = set(_PR_EVENT_FIELDS)
 
-            return pr_details
-        except Exception as e:
-            print(f"ERROR: Failed to extract PR details: {str(e)}")
-            sys.exit(1)
+        try:
+            for prefix, event, value in ijson.parse(event_file):
+                if prefix == "pull_request" and event == "start_map":
+                    is_pull_request = True
+                elif prefix in remaining and event not in _CONTAINER_EVENTS:
+                    pr_details[_PR_EVENT_FIELDS[prefix]] = value
+                    remaining.discard(prefix)
+                    if not remaining:
+                        break  # Everything we need; skip the rest of the payload
+        except ijson.JSONError:
+            raise ValueError("Failed to parse GitHub event file")
+
+        if not is_pull_request:
+            raise ValueError("This action can only run on pull_request events")
+
+        return pr_details
 
     def extract_images_from_description(self, description: str) -> list:
         """Extract image URLs from PR description"""
-        images = []
-        
-        # Markdown image format: ![alt](url)
-        markdown_pattern = r'!\[.*?\]\((.*?)\)'
-        markdown_matches = re.findall(markdown_pattern, description)
-        images.extend(markdown_matches)
-
-        # HTML image format: <img src="url">
-        html_pattern = r'<img[^>]+src=["\']([^"\']+)["\']'
-        html_matches = re.findall(html_pattern, description)
-        images.extend(html_matches)
-
-        return list(set(images))  # Remove duplicates
+        # Plain-text descriptions (the common case) skip the regex entirely
+        if not description or ("![" not in description and "<img" not in description.lower()):
+            return []
+
+        # Single pass over the description; first-seen order, duplicates removed
+        urls = (match.group(1) or match.group(2) for match in _IMAGE_PATTERN.finditer(description))
+        # Inline data: images can't be downloaded (and are stripped from the prompt instead)
+        return list(dict.fromkeys(url for url in urls if not url.lstrip().lower().startswith("data:")))
+
+    def fetch_image(self, method: str, image_url: str, **kwargs) -> requests.Response:
+        """Request an image URL, following redirects
+
+        The webhook server fetches URLs from untrusted PR descriptions, so there
+        every hop must be https to a public address (no internal hosts or
+        cloud metadata endpoints).
+        """
+        if not SERVE:
+            return self.session.request(method, image_url, allow_redirects=True, **kwargs)
+
+        url = image_url
+        for _ in range(5):
+            if not is_public_https_url(url):
+                raise ValueError(f"refusing to fetch {url}, not a public https URL")
+            response = self.session.request(method, url, allow_redirects=False, **kwargs)
+            if not response.is_redirect:
+                return response
+            response.close()
+            url = urljoin(url, response.headers["Location"])
+        raise ValueError(f"too many redirects from {image_url}")
+
+    def probe_image(self, image_url: str) -> bool:
+        """HEAD the URL and reject it only if it is clearly not an image or too large"""
+        try:
+            response = self.fetch_image("HEAD", image_url, timeout=5)
+        except Exception:
+            return True  # Inconclusive; the capped GET still protects us
+        if response.status_code != 200:
+            return True  # Some hosts (e.g. signed S3 URLs) refuse HEAD but allow GET
+
+        content_type = response.headers.get("Content-Type", "")
+        content_length = int(response.headers.get("Content-Length") or 0)
+        if content_type and not content_type.startswith("image/"):
+            print(f"WARNING: Skipping {image_url}, not an image ({content_type})")
+            return False
+        if content_length > MAX_IMAGE_BYTES:
+            print(f"WARNING: Skipping {image_url}, too large ({content_length} bytes)")
+            return False
+        return True
 
     def download_image(self, image_url: str) -> Optional[bytes]:
-        """Download image from URL"""
+        """Download image from URL and downscale it, refusing anything over MAX_IMAGE_BYTES"""
+        if SERVE and not is_public_https_url(image_url):
+            print(f"WARNING: Skipping {image_url}, not a public https URL")
+            return None
+
         try:
-            response = requests.get(image_url, timeout=10)
-            if response.status_code == 200:
-                return response.content
-            else:
-                print(f"WARNING: Failed to download image from {image_url}, status: {response.status_code}")
+            etag = self.etag_cache.get(image_url)
+            # A previously downloaded image is known to be acceptable; revalidate it instead
+            if etag is None and not self.probe_image(image_url):
                 return None
+
+            headers = {"If-None-Match": etag} if etag else None
+            with self.fetch_image("GET", image_url, timeout=10, stream=True, headers=headers) as response:
+                if response.status_code == 304 and etag is not None:
+                    return self.etag_cache.read(image_url)
+                if response.status_code != 200:
+                    print(f"WARNING: Failed to download image from {image_url}, status: {response.status_code}")
+                    return None
+
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES:
+                        print(f"WARNING: Skipping {image_url}, larger than {MAX_IMAGE_BYTES} bytes")
+                        return None
+                    chunks.append(chunk)
+
+                image_data = b"".join(chunks)
+                # Downscale before caching, so the ETag cache holds the small copy
+                image_data, _ = downscale_image(image_data, guess_image_mime_type(image_url, image_data))
+                new_etag = response.headers.get("ETag")
+                if new_etag:
+                    self.etag_cache.put(image_url, new_etag, image_data)
+                return image_data
         except Exception as e:
             print(f"WARNING: Failed to download image from {image_url}: {str(e)}")
             return None
 
-    def analyze_with_gemini(self, pr_details: Dict[str, Any]) -> str:
-        """Send PR details to Gemini AI and get analysis"""
+    async def _download_all(self, image_urls: list) -> list:
+        """Download images concurrently, returning (url, data) pairs in input order"""
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self.download_image, image_url) for image_url in image_urls)
+        )
+        await asyncio.to_thread(self.etag_cache.save)
+        return list(zip(image_urls, results))
+
+    def embed_pr(self, pr_details: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Embed PR title and description as a unit vector for the semantic cache"""
         try:
-            model = genai.GenerativeModel('gemini-2.5-flash')
+            text = f"{pr_details['title']}\n{clip_description(pr_details['description'])}"
+            result = genai.embed_content(model=EMBEDDING_MODEL, content=text)
+            vector = np.asarray(result["embedding"], dtype=np.float32)
+            return vector / np.linalg.norm(vector)
+        except Exception as e:
+            print(f"WARNING: Failed to embed PR for semantic cache: {str(e)}")
+            return None
 
-            # Build the prompt
-            prompt = f"""You are a helpful code reviewer AI assistant. Analyze the following pull request and provide a concise, crisp response in exactly 2 lines.
+    def lookup_cached_analysis(self, pr_details: Dict[str, Any]) -> Tuple[Optional[str], str, Optional[np.ndarray]]:
+        """Check the exact and semantic caches; returns (analysis or None, cache key, embedding)"""
+        cache_key = hashlib.sha256(
+            f"{pr_details['title']}\0{pr_details['description']}\0{pr_details['repo']}".encode()
+        ).hexdigest()
+        with _ANALYSIS_CACHE_LOCK:
+            cached = _ANALYSIS_CACHE.get(cache_key)
+        if cached is not None:
+            print(f"Analysis cache hit ({cache_key[:12]})")
+            return cached, cache_key, None
+        print(f"Analysis cache miss ({cache_key[:12]})")
+
+        embedding = self.embed_pr(pr_details)
+        if embedding is not None:
+            similar = _SEMANTIC_CACHE.lookup(pr_details['repo'], embedding)
+            if similar is not None:
+                print("Semantic cache hit (near-duplicate PR)")
+                with _ANALYSIS_CACHE_LOCK:
+                    _ANALYSIS_CACHE[cache_key] = similar
+                return similar, cache_key, embedding
+            print("Semantic cache miss")
+
+        return None, cache_key, embedding
+
+    def store_analysis(self, pr_details: Dict[str, Any], cache_key: str,
+                       embedding: Optional[np.ndarray], analysis: str):
+        """Remember a fresh analysis in the exact and semantic caches"""
+        with _ANALYSIS_CACHE_LOCK:
+            _ANALYSIS_CACHE[cache_key] = analysis
+        if embedding is not None:
+            _SEMANTIC_CACHE.add(pr_details['repo'], embedding, analysis)
+            _SEMANTIC_CACHE.save()
+
+    def generate_analysis(self, pr_details: Dict[str, Any]) -> str:
+        """Ask Gemini for the analysis of one PR, including its images"""
+        # Build the prompt (only the per-PR part; the reviewer role is the system instruction)
+        prompt = f"Analyze the following pull request.\n\n{format_pr_for_prompt(pr_details)}"
+
+        # Check if there are images to analyze
+        images_to_analyze = self.extract_images_from_description(pr_details['description'])
+
+        if images_to_analyze:
+            print(f"Found {len(images_to_analyze)} images in PR description. Attempting to analyze them...")
+
+            # Download (in parallel) and prepare images
+            image_parts = []
+            downloads = asyncio.run(self._download_all(images_to_analyze[:3]))  # Limit to 3 images
+            seen_digests = set()
+            for image_url, image_data in downloads:
+                if image_data:
+                    # The same upload can appear under several CDN URLs
+                    digest = hashlib.blake2b(image_data, digest_size=16).digest()
+                    if digest in seen_digests:
+                        print(f"Skipping duplicate image {image_url}")
+                        continue
+                    seen_digests.add(digest)
+
+                    image_parts.append({
+                        'mime_type': guess_image_mime_type(image_url, image_data),
+                        'data': image_data
+                    })
+
+            if image_parts:
+                # Include images in the analysis
+                content_parts = [prompt]
+                content_parts.extend(image_parts)
+                response = _MODEL.generate_content(content_parts, stream=True)
+            else:
+                response = _MODEL.generate_content(prompt, stream=True)
+        else:
+            response = _MODEL.generate_content(prompt, stream=True)
 
-Pull Request Title: {pr_details['title']}
+        return collect_stream_text(response)
 
-Pull Request Description:
-{pr_details['description']}
+    def generate_batch_analysis(self, batch: list) -> list:
+        """Analyze several text-only PRs from the same repository in one Gemini request
 
-Repository: {pr_details['repo']}
+        Returns one analysis per PR, in order; None where the response had no usable section.
+        """
+        if len({pr_details['repo'] for pr_details in batch}) > 1:
+            raise ValueError("Batched PRs must all come from the same repository")
 
-Please provide:
-1. A brief assessment of the PR (first line)
-2. A specific suggestion or observation (second line)
+        sections = "\n\n".join(
+            f"=== PR {i} ===\n{format_pr_for_prompt(pr_details)}"
+            for i, pr_details in enumerate(batch, start=1)
+        )
+        prompt = f"""Analyze each of the following {len(batch)} pull requests independently.
+For each one, write its marker line exactly as given (for example "=== PR 1 ===") followed by its 2-line analysis.
 
-Keep it short, professional, and actionable. Format as plain text, exactly 2 lines."""
+{sections}"""
 
-            # Check if there are images to analyze
-            images_to_analyze = self.extract_images_from_description(pr_details['description'])
-            
-            if images_to_analyze:
-                print(f"Found {len(images_to_analyze)} images in PR description. Attempting to analyze them...")
-                
-                # Download and prepare images
-                image_parts = []
-                for image_url in images_to_analyze[:3]:  # Limit to 3 images
-                    image_data = self.download_image(image_url)
-                    if image_data:
-                        # Determine image type
-                        if image_url.lower().endswith('.png'):
-                            mime_type = 'image/png'
-                        elif image_url.lower().endswith('.gif'):
-                            mime_type = 'image/gif'
-                        elif image_url.lower().endswith('.webp'):
-                            mime_type = 'image/webp'
-                        else:
-                            mime_type = 'image/jpeg'
-
-                        image_parts.append({
-                            'mime_type': mime_type,
-                            'data': image_data
-                        })
-
-                if image_parts:
-                    # Include images in the analysis
-                    content_parts = [prompt]
-                    content_parts.extend(image_parts)
-                    response = model.generate_content(content_parts)
-                else:
-                    response = model.generate_content(prompt)
-            else:
-                response = model.generate_content(prompt)
+        text = collect_stream_text(_MODEL.generate_content(prompt, stream=True))
 
-            analysis = response.text.strip()
+        # re.split with a capture group yields [preamble, number, body, number, body, ...]
+        parts = _BATCH_MARKER_PATTERN.split(text)
+        analyses = {int(number): body.strip() for number, body in zip(parts[1::2], parts[2::2])}
+        return [analyses.get(i) or None for i in range(1, len(batch) + 1)]
+
+    def analyze_with_gemini(self, pr_details: Dict[str, Any]) -> str:
+        """Send PR details to Gemini AI and get analysis"""
+        cached, cache_key, embedding = self.lookup_cached_analysis(pr_details)
+        if cached is not None:
+            return cached
+
+        try:
+            analysis = self.generate_analysis(pr_details)
+            self.store_analysis(pr_details, cache_key, embedding, analysis)
             return analysis
 
         except Exception as e:
             print(f"ERROR: Failed to analyze PR with Gemini: {str(e)}")
             sys.exit(1)
 
+    def prewarm_github_connection(self):
+        """Open a pooled connection to the GitHub API before the comment is ready"""
+        try:
+            # /rate_limit does not count against the API rate limit, and tells us how much is left
+            response = self.session.get("https://api.github.com/rate_limit", headers=self.headers, timeout=5)
+            wait_for_rate_limit(response)
+        except Exception:
+            pass  # Best effort; the POST opens its own connection if needed
+
     def post_comment_on_pr(self, repo: str, pr_number: int, comment_body: str) -> bool:
         """Post a comment on the PR"""
         try:
@@ -175,11 +845,30 @@ Keep it short, professional, and actionable. Format as plain text, exactly 2 lin
                 "body": f"🤖 **AI Analysis:**\n\n{comment_body}"
             }
 
-            response = requests.post(url, json=data, headers=self.headers)
+            def send() -> requests.Response:
+                return self.session.post(
+                    url,
+                    data=orjson.dumps(data),
+                    headers={**self.headers, "Content-Type": "application/json"},
+                )
+
+            response = send()
+
+            # Primary rate limit: a 403/429 without Retry-After, so urllib3 won't wait it out
+            delay = primary_rate_limit_delay(response)
+            if delay is not None and delay <= RATE_LIMIT_MAX_WAIT:
+                print(f"WARNING: GitHub API rate limit exhausted; retrying in {delay:.0f}s when it resets")
+                time.sleep(delay)
+                response = send()
+            elif delay is not None:
+                print(f"ERROR: GitHub API rate limit exhausted; it resets in {delay:.0f}s, longer than we wait")
+            if SERVE:
+                # Only the webhook server makes further API calls after this one
+                wait_for_rate_limit(response)
 
             if response.status_code == 201:
                 comment = response.json()
-                print(f"✅ Successfully posted comment on PR #{pr_number}")
+                print(f"{OK} Successfully posted comment on PR #{pr_number}")
                 print(f"Comment ID: {comment['id']}")
                 return True
             else:
@@ -191,33 +880,98 @@ Keep it short, professional, and actionable. Format as plain text, exactly 2 lin
             print(f"ERROR: Failed to post comment on PR: {str(e)}")
             sys.exit(1)
 
-    def run(self):
+    async def process_webhook_pr(self, pr_details: Dict[str, Any]):
+        """Analyze and comment on a PR received by the webhook server"""
+        print(f"Processing PR #{pr_details['number']} in {pr_details['repo']} ({pr_details['action']})")
+        try:
+            analysis, cache_key, embedding = await asyncio.to_thread(self.lookup_cached_analysis, pr_details)
+            if analysis is None:
+                analysis = await self.batcher.analyze(pr_details)
+                await asyncio.to_thread(self.store_analysis, pr_details, cache_key, embedding, analysis)
+
+            success = await asyncio.get_running_loop().run_in_executor(
+                self.comment_executor,
+                self.post_comment_on_pr,
+                pr_details['repo'],
+                pr_details['number'],
+                analysis
+            )
+        except Exception as e:
+            print(f"ERROR: Failed to analyze PR with Gemini: {str(e)}")
+            success = False
+        except SystemExit:
+            # The comment step exits on failure in action mode; the server keeps running
+            success = False
+
+        if not success:
+            print(f"ERROR: Failed to process PR #{pr_details['number']} in {pr_details['repo']}")
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Verify a GitHub webhook delivery and queue the PR for analysis"""
+        body = await request.read()
+
+        expected = "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(request.headers.get("X-Hub-Signature-256", ""), expected):
+            return web.Response(status=401, text="Invalid signature")
+
+        if request.headers.get("X-GitHub-Event") != "pull_request":
+            return web.Response(status=204)  # ping and other events
+
+        try:
+            pr_details = self.extract_pr_details(BytesIO(body))
+        except ValueError as e:
+            return web.Response(status=400, text=str(e))
+
+        if pr_details['action'] not in PR_ACTIONS:
+            return web.Response(status=204)
+
+        # Reply straight away; GitHub times out deliveries after 10 seconds
+        task = asyncio.create_task(self.process_webhook_pr(pr_details))
+        self.webhook_tasks.add(task)
+        task.add_done_callback(self.webhook_tasks.discard)
+        return web.Response(status=202, text="Accepted")
+
+    async def _run_batcher(self, app: web.Application):
+        """Start the analysis batcher with the server and stop it on shutdown"""
+        self.batcher = AnalysisBatcher(self)
+        task = asyncio.create_task(self.batcher.run())
+        yield
+        task.cancel()
+
+    def serve(self, port: int):
+        """Run as a long-lived webhook worker, reusing the session, model and caches"""
+        app = web.Application()
+        app.router.add_post("/webhook", self.handle_webhook)
+        app.cleanup_ctx.append(self._run_batcher)
+        print(f"Listening for GitHub webhooks on port {port} (POST /webhook)")
+        web.run_app(app, port=port, print=None)
+
+    async def run(self):
         """Main execution flow"""
         print("=" * 60)
         print("Starting PR Analysis with Gemini AI")
         print("=" * 60)
 
-        # Load GitHub context
-        print("\n📂 Loading GitHub context...")
-        context = self.load_github_context()
-
-        # Extract PR details
-        print("📝 Extracting PR details...")
-        pr_details = self.extract_pr_details(context)
+        # Extract PR details from the GitHub context
+        print(f"\n{INFO} Loading GitHub context...")
+        print(f"{INFO} Extracting PR details...")
+        pr_details = self.load_pr_details()
         print(f"   PR #{pr_details['number']}: {pr_details['title']}")
         print(f"   Repository: {pr_details['repo']}")
 
-        # Analyze with Gemini
-        print("\n🤖 Analyzing PR with Gemini AI...")
-        analysis = self.analyze_with_gemini(pr_details)
+        # Analyze with Gemini, opening the GitHub API connection meanwhile
+        print(f"\n{BOT} Analyzing PR with Gemini AI...")
+        prewarm = asyncio.create_task(asyncio.to_thread(self.prewarm_github_connection))
+        analysis = await asyncio.to_thread(self.analyze_with_gemini, pr_details)
+        await prewarm
 
-        print("\n📤 Generated Analysis:")
+        print(f"\n{INFO} Generated Analysis:")
         print("-" * 60)
         print(analysis)
         print("-" * 60)
 
         # Post comment on PR
-        print("\n💬 Posting comment on PR...")
+        print(f"\n{INFO} Posting comment on PR...")
         success = self.post_comment_on_pr(
             pr_details['repo'],
             pr_details['number'],
@@ -226,13 +980,16 @@ Keep it short, professional, and actionable. Format as plain text, exactly 2 lin
 
         if success:
             print("\n" + "=" * 60)
-            print("✅ PR Analysis and Comment Successfully Completed!")
+            print(f"{OK} PR Analysis and Comment Successfully Completed!")
             print("=" * 60)
         else:
-            print("\n❌ Failed to post comment on PR")
+            print(f"\n{FAIL} Failed to post comment on PR")
             sys.exit(1)
 
 
 if __name__ == "__main__":
     analyzer = PRAnalyzer(GITHUB_TOKEN, GEMINI_API_KEY)
-    analyzer.run()
+    if SERVE:
+        analyzer.serve(PORT)
+    else:
+        asyncio.run(analyzer.run())
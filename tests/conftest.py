@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# analyze_pr validates its environment at import time
+os.environ.setdefault("GITHUB_TOKEN", "test-token")
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("GITHUB_EVENT_PATH", os.devnull)
+os.environ.setdefault("PR_ANALYZER_CACHE_DIR", tempfile.mkdtemp(prefix="pr-analyzer-test-"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
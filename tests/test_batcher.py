@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+import analyze_pr
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text]
+
+
+class _RecordingModel:
+    """Stands in for the Gemini model and answers every PR in the prompt"""
+
+    def __init__(self):
+        self.prompts = []
+
+    def generate_content(self, prompt, stream=False):
+        self.prompts.append(prompt)
+        count = prompt.count("Pull Request Title:")
+        return [_Chunk("\n".join(f"=== PR {i} ===\nline one\nline two" for i in range(1, count + 1)))]
+
+
+def _pr(repo, number):
+    return {"title": f"PR {number}", "description": "plain text", "repo": repo, "number": number}
+
+
+def test_batches_never_mix_repositories(monkeypatch):
+    model = _RecordingModel()
+    monkeypatch.setattr(analyze_pr, "_MODEL", model)
+    prs = [_pr("private/repo", 1), _pr("public/repo", 2), _pr("private/repo", 3), _pr("public/repo", 4)]
+
+    async def analyze_all():
+        batcher = analyze_pr.AnalysisBatcher(analyze_pr.PRAnalyzer("token", "key"))
+        runner = asyncio.create_task(batcher.run())
+        try:
+            return await asyncio.gather(*(batcher.analyze(pr) for pr in prs))
+        finally:
+            runner.cancel()
+
+    results = asyncio.run(analyze_all())
+
+    assert results == ["line one\nline two"] * len(prs)
+    assert len(model.prompts) == 2
+    for prompt in model.prompts:
+        assert ("private/repo" in prompt) != ("public/repo" in prompt)
+
+
+def test_generate_batch_analysis_rejects_mixed_repositories(monkeypatch):
+    model = _RecordingModel()
+    monkeypatch.setattr(analyze_pr, "_MODEL", model)
+    analyzer = analyze_pr.PRAnalyzer("token", "key")
+
+    with pytest.raises(ValueError):
+        analyzer.generate_batch_analysis([_pr("private/repo", 1), _pr("public/repo", 2)])
+    assert model.prompts == []
@@ -0,0 +1,29 @@
+import os
+
+import analyze_pr
+
+
+def _cache(tmp_path, **limits):
+    return analyze_pr.ETagCache(str(tmp_path / "etags.json"), str(tmp_path / "images"), **limits)
+
+
+def test_evicts_oldest_past_max_bytes(tmp_path):
+    cache = _cache(tmp_path, max_bytes=250)
+    for i in range(3):
+        cache.put(f"https://example.com/{i}.png", f'"v{i}"', b"x" * 100)
+
+    assert cache.get("https://example.com/0.png") is None
+    assert not os.path.exists(cache._data_path("https://example.com/0.png"))
+    assert cache.get("https://example.com/1.png") == '"v1"'
+    assert cache.read("https://example.com/2.png") == b"x" * 100
+
+
+def test_index_round_trips_and_skips_old_format(tmp_path):
+    cache = _cache(tmp_path)
+    cache.put("https://example.com/a.png", '"a"', b"data")
+    cache.save()
+
+    (tmp_path / "old.json").write_bytes(b'{"https://example.com/a.png": "\\"a\\""}')
+    assert _cache(tmp_path).get("https://example.com/a.png") == '"a"'
+    old = analyze_pr.ETagCache(str(tmp_path / "old.json"), str(tmp_path / "images"))
+    assert old.get("https://example.com/a.png") is None
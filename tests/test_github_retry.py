@@ -0,0 +1,21 @@
+import analyze_pr
+
+
+def _retry():
+    return analyze_pr.GitHubRetry(total=5, status_forcelist=[403, 429, 502, 503, 504],
+                                  allowed_methods=frozenset(["GET"]))
+
+
+def test_post_retries_only_secondary_rate_limits():
+    retry = _retry()
+    assert retry.is_retry("POST", 429, has_retry_after=True)
+    assert retry.is_retry("POST", 403, has_retry_after=True)
+    assert not retry.is_retry("POST", 429)
+    assert not retry.is_retry("POST", 502)
+
+
+def test_get_retries_gateway_errors_but_not_permission_errors():
+    retry = _retry()
+    assert retry.is_retry("GET", 502)
+    assert retry.is_retry("GET", 429)
+    assert not retry.is_retry("GET", 403)
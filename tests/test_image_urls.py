@@ -0,0 +1,54 @@
+import io
+
+import pytest
+import requests
+
+import analyze_pr
+
+
+@pytest.mark.parametrize("url", [
+    "http://8.8.8.8/a.png",
+    "https://127.0.0.1/a.png",
+    "https://localhost/a.png",
+    "https://169.254.169.254/latest/meta-data/",
+    "https://10.0.0.5/a.png",
+    "https://[::1]/a.png",
+    "data:image/png;base64,iVBORw0KGgo=",
+])
+def test_rejects_non_public_urls(url):
+    assert not analyze_pr.is_public_https_url(url)
+
+
+def test_accepts_public_https_url():
+    assert analyze_pr.is_public_https_url("https://8.8.8.8/a.png")
+
+
+def test_server_mode_refuses_redirect_to_internal_host(monkeypatch):
+    monkeypatch.setattr(analyze_pr, "SERVE", True)
+    analyzer = analyze_pr.PRAnalyzer("token", "key")
+    requested = []
+
+    def request(method, url, **kwargs):
+        requested.append(url)
+        response = requests.Response()
+        response.status_code = 302
+        response.raw = io.BytesIO()
+        response.headers["Location"] = "http://169.254.169.254/latest/meta-data/"
+        return response
+
+    monkeypatch.setattr(analyzer.session, "request", request)
+    with pytest.raises(ValueError):
+        analyzer.fetch_image("GET", "https://8.8.8.8/a.png")
+    assert requested == ["https://8.8.8.8/a.png"]
+    assert analyzer.download_image("https://169.254.169.254/a.png") is None
+
+
+def test_extract_images_skips_data_uris():
+    analyzer = analyze_pr.PRAnalyzer("token", "key")
+    description = (
+        "![inline](data:image/png;base64,iVBORw0KGgo=)\n"
+        '<img src="DATA:image/gif;base64,R0lGODlh">\n'
+        "![shot](https://example.com/a.png) ![again](https://example.com/a.png)"
+    )
+    assert analyzer.extract_images_from_description(description) == ["https://example.com/a.png"]
+    assert analyzer.extract_images_from_description("![x](data:image/png;base64,AAAA)") == []